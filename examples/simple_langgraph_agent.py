@@ -6,15 +6,32 @@ This demo shows:
 - LangGraph streaming APIs: astream(stream_mode="values") for step-by-step progress
 - Graph-level interrupts: interrupt_after=["confirm"] to pause durably between steps
 - Using a local OpenAI-compatible model (e.g. vLLM) via OPENAI_BASE_URL
+
+Run with ``--mode repl`` (default) for the interactive demo, or ``--mode batch``
+to answer the given questions concurrently, one thread_id each.
 """
 
+import argparse
 import asyncio
+import contextlib
+import functools
+import logging
 import os
+import threading
+from collections.abc import AsyncIterator
 from pathlib import Path
 from typing import Literal
+from uuid import uuid4
+
+import aiosqlite
 
 from langchain.chat_models import init_chat_model
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.messages import (
+    AIMessage,
+    HumanMessage,
+    SystemMessage,
+    message_chunk_to_message,
+)
 from langchain_core.runnables import RunnableConfig
 
 # LangGraph: 核心图与状态模块
@@ -27,17 +44,19 @@ from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 def _load_env_from_repo_root() -> None:
     """Load .env from the repo root so local vLLM config is available."""
-    env_path = Path(__file__).resolve().parents[1] / ".env"
-    if not env_path.exists():
+    # 同一进程（以及继承环境的子进程）里只解析一次
+    if os.environ.get("_REPO_ENV_LOADED"):
         return
-    for line in env_path.read_text(encoding="utf-8").splitlines():
-        if not line or line.strip().startswith("#") or "=" not in line:
-            continue
-        key, value = line.split("=", 1)
-        key = key.strip()
-        value = value.strip()
-        if key and os.getenv(key) is None:
-            os.environ[key] = value 
+    env_path = Path(__file__).resolve().parents[1] / ".env"
+    if env_path.exists():
+        for line in env_path.read_text(encoding="utf-8").splitlines():
+            if not line or line.strip().startswith("#"):
+                continue
+            key, sep, value = line.partition("=")
+            key = key.strip()
+            if sep and key and os.getenv(key) is None:
+                os.environ[key] = value.strip()
+    os.environ["_REPO_ENV_LOADED"] = "1"
 
 
 _load_env_from_repo_root()
@@ -53,16 +72,149 @@ configurable_model = init_chat_model(
 )
 
 
+@functools.lru_cache(maxsize=16)
+def _get_model(model_name: str, max_tokens: int, api_key: str | None):
+    """Return the configured model runnable, cached per (model, max_tokens, api_key)."""
+    return configurable_model.with_config(
+        {
+            "model": model_name,
+            "max_tokens": max_tokens,
+            "api_key": api_key,
+        }
+    )
+
+
+# 系统提示是常量，只构造一次
+_SYS_MSG = SystemMessage(
+    content="你是一个对话助手，会结合整个历史对话来回答用户当前的问题。"
+)
+
+
 # LangGraph persistence: SQLite 检查点路径
 CHECKPOINT_PATH = Path(__file__).resolve().parents[1] / "simple_agent_checkpoints.sqlite"
 
+# SQLite 调优：WAL 模式下安全的一组 PRAGMA
+# （saver.setup() 本身也会开 WAL；这里主要加上 synchronous=NORMAL 等设置来减少 fsync）
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=10737418240",
+    "PRAGMA busy_timeout=3000",
+    # 关掉自动 checkpoint，改由后台任务定期合并 WAL，避免某次 COMMIT 卡住事件循环
+    "PRAGMA wal_autocheckpoint=0",
+)
+
+# 后台 WAL checkpoint 的间隔（秒）
+WAL_CHECKPOINT_INTERVAL = 60
+
+# REPL 提问提示语
+QUESTION_PROMPT = "你想问什么？(输入 exit 退出) "
+
+# 用户选择不回答时写入的回复
+DECLINE_REPLY = "好的，那我先不回答。"
+
+
+async def _configure_sqlite(checkpointer: AsyncSqliteSaver) -> None:
+    """Apply WAL mode plus relaxed (but WAL-safe) fsync and cache settings."""
+    for pragma in SQLITE_PRAGMAS:
+        await checkpointer.conn.execute(pragma)
+
+
+@contextlib.asynccontextmanager
+async def open_checkpointer(
+    path: Path = CHECKPOINT_PATH,
+) -> AsyncIterator[AsyncSqliteSaver]:
+    """Open the SQLite checkpointer with tuned PRAGMAs and background WAL checkpointing.
+
+    The saver keeps its default serializer; what this adds on top of
+    ``AsyncSqliteSaver.setup()`` (which already enables WAL) is synchronous=NORMAL,
+    the cache/mmap settings and manual WAL checkpoints.
+    """
+    async with aiosqlite.connect(str(path)) as conn:
+        checkpointer = AsyncSqliteSaver(conn)
+        await _configure_sqlite(checkpointer)
+        # 自动 checkpoint 已关掉（wal_autocheckpoint=0），由后台任务定期合并 WAL；退出时取消
+        wal_task = asyncio.create_task(_wal_checkpointer(checkpointer))
+        try:
+            yield checkpointer
+        finally:
+            wal_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await wal_task
+
+
+async def _wal_checkpointer(
+    checkpointer: AsyncSqliteSaver, interval: float = WAL_CHECKPOINT_INTERVAL
+) -> None:
+    """Periodically fold the WAL back into the main DB so readers don't scan a growing log."""
+    while True:
+        await asyncio.sleep(interval)
+        # 与检查点写入共用同一个连接，拿 saver 自己的锁避免交错
+        async with checkpointer.lock:
+            async with checkpointer.conn.execute(
+                "PRAGMA wal_checkpoint(TRUNCATE)"
+            ) as cursor:
+                row = await cursor.fetchone()
+            await checkpointer.conn.execute("PRAGMA optimize")
+        if row is not None:
+            busy, log, checkpointed = row
+            if busy or log != checkpointed:
+                logging.warning(
+                    f"WAL checkpoint incomplete: busy={busy}, log={log}, checkpointed={checkpointed}"
+                )
+
+
+def _is_exit(user_input: str) -> bool:
+    """Return True if the REPL input means quit (blank or ``exit``)."""
+    return not user_input.strip() or user_input.strip().lower() == "exit"
+
+
+async def _ainput(prompt: str) -> str:
+    """Read a line from stdin without blocking the event loop.
+
+    Uses a daemon thread instead of asyncio.to_thread: asyncio.run joins the default
+    executor on shutdown, so a worker stuck in input() would keep Ctrl-C from exiting.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _set_result(line: str) -> None:
+        if not future.done():
+            future.set_result(line)
+
+    def _set_exception(exc: Exception) -> None:
+        if not future.done():
+            future.set_exception(exc)
+
+    def _read() -> None:
+        # 事件循环可能已经关闭（比如用户按了 Ctrl-C），此时直接丢弃结果
+        with contextlib.suppress(RuntimeError):
+            try:
+                line = input(prompt)
+            except Exception as e:
+                loop.call_soon_threadsafe(_set_exception, e)
+            else:
+                loop.call_soon_threadsafe(_set_result, line)
+
+    threading.Thread(target=_read, daemon=True).start()
+    return await future
+
 
 async def router(
     state: SimpleState, config: RunnableConfig
 ) -> Command[Literal["confirm", "__end__"]]:
     """Route to the confirm node if there is a user question."""
     last = state["messages"][-1] if state["messages"] else None
-    if isinstance(last, HumanMessage) and str(last.content).strip():
+    # 精确类型判断 + isspace()，不用 str(...).strip() 额外分配字符串
+    content = getattr(last, "content", None)
+    if (
+        type(last) is HumanMessage
+        and isinstance(content, str)
+        and content
+        and not content.isspace()
+    ):
         return Command(goto="confirm")
     return Command(
         goto=END,
@@ -81,10 +233,8 @@ def confirm(state: SimpleState, config: RunnableConfig):
     return {}
 
 
-async def answer(state: SimpleState, config: RunnableConfig):
-    """Call a chat model using full conversation history and a local vLLM endpoint."""
-    configurable = config.get("configurable", {}) if config else {}
-
+def _model_settings(configurable: dict) -> tuple[str, int, str | None]:
+    """Resolve (model, max_tokens, api_key) from the configurable dict and environment."""
     # 默认使用你本地 vLLM 暴露的模型
     model_name = configurable.get(
         "model", "openai:mistralai/Ministral-3-14B-Reasoning-2512"
@@ -95,133 +245,243 @@ async def answer(state: SimpleState, config: RunnableConfig):
     api_key = configurable.get("api_key") or os.getenv("OPENAI_API_KEY")
     if not api_key and os.getenv("OPENAI_BASE_URL"):
         api_key = "dummy"
+    return model_name, max_tokens, api_key
 
-    model = configurable_model.with_config(
-        {
-            "model": model_name,
-            "max_tokens": max_tokens,
-            "api_key": api_key,
-        }
-    )
+
+async def _warm_model(configurable: dict | None = None) -> None:
+    """Open the HTTP connection to the local model server ahead of the first real turn."""
+    # 只预热本地 OpenAI 兼容服务（如 vLLM）；没配 OPENAI_BASE_URL 时不要去打公网 API
+    if not os.getenv("OPENAI_BASE_URL"):
+        return
+    model_name, _, api_key = _model_settings(configurable or {})
+    try:
+        # 只生成 1 个 token；底层 httpx 连接池在各个模型实例间共享，后续请求直接复用 keep-alive 连接
+        await _get_model(model_name, 1, api_key).ainvoke([HumanMessage(content="ping")])
+    except Exception as e:
+        logging.warning(f"Model warm-up failed: {e}")
+
+
+async def answer(state: SimpleState, config: RunnableConfig):
+    """Call a chat model using full conversation history and a local vLLM endpoint."""
+    configurable = config.get("configurable", {}) if config else {}
+    # 同一配置的模型句柄由 _get_model 的 lru_cache 复用，不会每轮重新包装
+    model = _get_model(*_model_settings(configurable))
 
     # 使用整个对话历史，而不是只看最后一句
     history = state["messages"]
-    system_msg = SystemMessage(
-        content="你是一个对话助手，会结合整个历史对话来回答用户当前的问题。"
-    )
-    response = await model.ainvoke([system_msg, *history])
-    return {"messages": [response]}
 
-
-# LangGraph: 构建简单的图（router -> confirm -> answer）
-builder = StateGraph(SimpleState)
-builder.add_node("router", router)
-builder.add_node("confirm", confirm)
-builder.add_node("answer", answer)
-builder.add_edge(START, "router")
-builder.add_edge("router", "confirm")
-builder.add_edge("confirm", "answer")
-builder.add_edge("answer", END)
+    # 流式读取 vLLM 的 token：边生成边打印，首 token 延迟只剩一次往返
+    # batch_run 并发跑多个 thread 时关掉打印（stream_tokens=False），避免输出交错
+    stream_tokens = configurable.get("stream_tokens", True)
+    if stream_tokens:
+        print("Agent: ", end="", flush=True)
+    prompt = [_SYS_MSG, *history]
+    response = None
+    async for chunk in model.astream(prompt):
+        if stream_tokens:
+            print(chunk.content, end="", flush=True)
+        response = chunk if response is None else response + chunk
+    if response is None:
+        # 流里一个 chunk 都没有：退回到一次普通调用，保证总能返回一条 AIMessage
+        response = await model.ainvoke(prompt)
+        if stream_tokens:
+            print(response.content, end="")
+    if stream_tokens:
+        print()
+    return {"messages": [message_chunk_to_message(response)]}
+
+
+def build_graph() -> StateGraph:
+    """Build the (uncompiled) graph: router -> confirm -> answer."""
+    builder = StateGraph(SimpleState)
+    builder.add_node("router", router)
+    builder.add_node("confirm", confirm)
+    builder.add_node("answer", answer)
+    # router 自己用 Command(goto=...) 决定下一步，不需要静态边
+    builder.add_edge(START, "router")
+    builder.add_edge("confirm", "answer")
+    builder.add_edge("answer", END)
+    return builder
+
+
+async def _resume_after_confirm(
+    simple_graph, config: dict, decision: str
+) -> tuple[list, bool]:
+    """Resume a run paused after ``confirm``: answer on yes, otherwise end with a decline reply.
+
+    Returns the latest messages and whether the answer node ran.
+    """
+    answered = str(decision).strip().lower() in {"y", "yes"}
+    if not answered:
+        # no：以 answer 节点的身份写入回复，线程直接结束，answer 不会运行。
+        # （从中断处恢复时传 Command(goto=END) 并不能阻止已排定的 answer 节点执行）
+        await simple_graph.aupdate_state(
+            config,
+            {"messages": [AIMessage(content=DECLINE_REPLY)]},
+            as_node="answer",
+        )
+        snapshot = await simple_graph.aget_state(config)
+        return snapshot.values.get("messages", []), answered
+
+    # yes：从暂停处继续跑 answer
+    messages: list = []
+    # durability="exit"：整个恢复过程只在结束时写一次检查点（一次提交、一次 fsync）。
+    # 中途崩溃的话，检查点仍停在 confirm 之后，下次启动会再问一次是否继续。
+    async for chunk in simple_graph.astream(
+        None,
+        config=config,
+        stream_mode="values",
+        durability="exit",
+        interrupt_after=["confirm"],
+    ):
+        if "messages" in chunk:
+            messages = chunk["messages"]
+    return messages, answered
+
+
+async def batch_run(
+    questions: list[str], concurrency: int = 8
+) -> list[dict | BaseException]:
+    """Answer independent questions in parallel, one thread_id per question.
+
+    vLLM batches concurrent requests itself, so we only cap in-flight runs with a semaphore.
+    A failed run shows up as its exception in the result list instead of discarding the rest.
+    """
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be >= 1, got {concurrency}")
+    async with open_checkpointer() as checkpointer:
+        # 只编译一次，所有 thread 共用同一个编译好的图
+        simple_graph = build_graph().compile(checkpointer=checkpointer)
+
+        # 每次调用用新的前缀，保证每个问题都是全新的对话，不会接上之前 batch 的历史
+        prefix = f"batch-{uuid4().hex}"
+        configs = [
+            {"configurable": {"thread_id": f"{prefix}-{i}", "stream_tokens": False}}
+            for i in range(len(questions))
+        ]
+        sem = asyncio.Semaphore(concurrency)
+
+        async def _one(question: str, config: dict) -> dict:
+            async with sem:
+                return await simple_graph.ainvoke(
+                    {"messages": [HumanMessage(content=question)]}, config=config
+                )
+
+        return await asyncio.gather(
+            *[_one(q, c) for q, c in zip(questions, configs)],
+            return_exceptions=True,
+        )
 
 
 async def main() -> None:
     """Simple REPL that keeps conversation history across runs using SQLite persistence."""
     # LangGraph persistence: 使用异步 SQLite 检查点，需要在 async with 上下文中创建 AsyncSqliteSaver
-    async with AsyncSqliteSaver.from_conn_string(str(CHECKPOINT_PATH)) as checkpointer:
+    # open_checkpointer 在编译图之前先调好 SQLite：synchronous=NORMAL 等，每次写检查点少一次 fsync
+    async with open_checkpointer() as checkpointer:
         # LangGraph persistence: 将检查点后端挂到图上
-        simple_graph = builder.compile(checkpointer=checkpointer)
-
-        # LangGraph persistence: 使用 thread_id 区分不同会话
-        thread_id = "simple-langgraph-agent-demo"
-        config = {"configurable": {"thread_id": thread_id}}
-
-        # LangGraph persistence: 启动时尝试从检查点恢复历史消息（异步版本）
-        messages: list = []
-        snapshot = await simple_graph.aget_state(config)
-        if snapshot is not None and snapshot.values:
-            existing = snapshot.values.get("messages")
-            if isinstance(existing, list):
-                messages = existing
-
-        # Durable execution（图级别暂停点）：
-        # 我们每次都把图跑到 confirm 之后就暂停（interrupt_after=["confirm"]），
-        # 所以如果你上次运行在 confirm 后退出了，这里会看到 next 里还有 "answer"。
-        if snapshot is not None and snapshot.next and "answer" in snapshot.next:
-            decision = input("检测到上次停在确认步骤：要继续回答吗？输入 yes/no ")
-            if str(decision).strip().lower() in {"y", "yes"}:
-                async for chunk in simple_graph.astream(
-                    None,
-                    config=config,
-                    stream_mode="values",
-                    durability="sync",
-                    interrupt_after=["confirm"],
-                ):
-                    if "messages" in chunk:
-                        messages = chunk["messages"]
-            else:
-                async for chunk in simple_graph.astream(
-                    Command(
-                        goto=END,
-                        update={"messages": [AIMessage(content="好的，那我先不回答。")]},
-                    ),
-                    config=config,
-                    stream_mode="values",
-                    durability="sync",
-                ):
-                    if "messages" in chunk:
-                        messages = chunk["messages"]
-
-        while True:
-            user_input = input("你想问什么？(输入 exit 退出) ")
-            if not user_input.strip() or user_input.strip().lower() == "exit":
-                break
-
-            messages.append(HumanMessage(content=user_input))
-
-            # LangGraph streaming:
-            # - astream(..., stream_mode="values") 会按“步骤”产出当前 state 的快照
-            # - 我们一边读流，一边更新 messages（对话历史）
-            # - interrupt_after=["confirm"]：在 confirm 节点之后暂停（并把 next="answer" 存到 SQLite）
-            async for chunk in simple_graph.astream(
-                {"messages": messages},
-                config=config,
-                stream_mode="values",
-                durability="sync",
-                interrupt_after=["confirm"],
+        simple_graph = build_graph().compile(checkpointer=checkpointer)
+
+        # 和读取快照、等待用户输入并行，提前建好到 vLLM 的连接
+        warm_task = asyncio.create_task(_warm_model())
+        try:
+            # LangGraph persistence: 使用 thread_id 区分不同会话
+            thread_id = "simple-langgraph-agent-demo"
+            config = {"configurable": {"thread_id": thread_id}}
+
+            # LangGraph persistence: 历史消息都在检查点里，启动时只需读出暂停位置（异步版本）
+            # 读 SQLite 和等用户输入第一个问题同时进行，把读盘时间藏在打字时间里
+            snapshot, user_input = await asyncio.gather(
+                simple_graph.aget_state(config),
+                _ainput(QUESTION_PROMPT),
+            )
+
+            # Durable execution（图级别暂停点）：
+            # 我们每次都把图跑到 confirm 之后就暂停（interrupt_after=["confirm"]），
+            # 所以如果你上次运行在 confirm 后退出了，这里会看到 next 里还有 "answer"。
+            # 先处理完上次暂停的那一轮，再提交本轮的新问题；如果第一次输入就是退出，则不再追问。
+            if (
+                not _is_exit(user_input)
+                and snapshot is not None
+                and snapshot.next
+                and "answer" in snapshot.next
             ):
-                if "messages" in chunk:
-                    messages = chunk["messages"]
+                decision = await _ainput("检测到上次停在确认步骤：要继续回答吗？输入 yes/no ")
+                await _resume_after_confirm(simple_graph, config, decision)
 
-            decision = input("要现在回答吗？输入 yes/no ")
-            if str(decision).strip().lower() in {"y", "yes"}:
-                async for chunk in simple_graph.astream(
-                    None,
+            while True:
+                if _is_exit(user_input):
+                    break
+
+                # LangGraph streaming:
+                # - 只发送本轮新的 HumanMessage，add_messages reducer 会把它追加到检查点里的历史后面
+                # - astream(..., stream_mode="values") 会按“步骤”产出当前 state 的快照
+                # - interrupt_after=["confirm"]：在 confirm 节点之后暂停（并把 next="answer" 存到 SQLite）
+                # - 最新的 messages 在确认之后由 _resume_after_confirm 返回
+                # - router/confirm 几乎不改 state，用 durability="async" 不必每步等 fsync；
+                #   恢复执行那一步在结束时一次性写入（见 _resume_after_confirm）
+                async for _ in simple_graph.astream(
+                    {"messages": [HumanMessage(content=user_input)]},
                     config=config,
                     stream_mode="values",
-                    durability="sync",
+                    durability="async",
                     interrupt_after=["confirm"],
                 ):
-                    if "messages" in chunk:
-                        messages = chunk["messages"]
-            else:
-                async for chunk in simple_graph.astream(
-                    Command(
-                        goto=END,
-                        update={"messages": [AIMessage(content="好的，那我先不回答。")]},
-                    ),
-                    config=config,
-                    stream_mode="values",
-                    durability="sync",
+                    pass
+
+                decision = await _ainput("要现在回答吗？输入 yes/no ")
+                messages, answered = await _resume_after_confirm(
+                    simple_graph, config, decision
+                )
+
+                # 回答时 answer 节点已经流式打印过了，这里只打印“不回答”的回复
+                # 回复总是最后追加的那条消息，直接看末尾即可
+                last = messages[-1] if messages else None
+                if (
+                    not answered
+                    and isinstance(last, AIMessage)
+                    and last.content == DECLINE_REPLY
                 ):
-                    if "messages" in chunk:
-                        messages = chunk["messages"]
-
-            # 打印本轮最新的 AI 回复
-            for msg in reversed(messages):
-                if isinstance(msg, AIMessage):
-                    print("Agent:", msg.content)
-                    break
+                    print("Agent:", last.content)
+
+                user_input = await _ainput(QUESTION_PROMPT)
+        finally:
+            warm_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await warm_task
+
+
+async def _run_batch(questions: list[str], concurrency: int) -> None:
+    """Run batch_run and print each question with its final reply."""
+    results = await batch_run(questions, concurrency=concurrency)
+    for question, result in zip(questions, results):
+        print("You:", question)
+        if isinstance(result, BaseException):
+            print("Error:", repr(result))
+        else:
+            print("Agent:", result["messages"][-1].content)
+
+
+def _parse_args() -> argparse.Namespace:
+    """Parse command-line arguments for the demo."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("repl", "batch"), default="repl")
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="batch 模式下同时运行的 thread 数"
+    )
+    parser.add_argument("questions", nargs="*", help="batch 模式下要回答的问题")
+    args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency 必须 >= 1")
+    if args.mode == "batch" and not args.questions:
+        parser.error("--mode batch 需要至少一个问题")
+    if args.mode == "repl" and args.questions:
+        parser.error("问题参数只在 --mode batch 下使用")
+    return args
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = _parse_args()
+    if args.mode == "batch":
+        asyncio.run(_run_batch(args.questions, args.concurrency))
+    else:
+        asyncio.run(main())